@@ -5,108 +5,348 @@
 Class to analyze an audio file with a Lambda function and to store the
 results in a DynamoDB table.
 
-Note: python-ffmpeg is dependent on ffmpeg binaries (https://ffmpeg.org/download.html).
+Note: the ffmpeg binary (https://ffmpeg.org/download.html) must be on the PATH, and ffprobe
+as well for copy_compatible_audio.
 
 Changelog:
 9/16/2025, Todd Stephenson: Initial version
 2/25/2026, Todd Stephenson: Reattempt failed endpoint invocation and unprocessed dynamodb writes
+10/15/2026, Todd Stephenson: Pipe ogg from ffmpeg without python-ffmpeg, reattempt with exponential backoff,
+    optional asynchronous invocation, WCU rate limiting of concurrent dynamodb writes and
+    copying of compatible audio
  '''
 
-__version__ = "0.0.2"
+__version__ = "0.0.3"
 __status__ = "Development"
 __copyright__ = "Copyright Todd Stephenson. All Rights Reserved."
 __author__ = "Todd Stephenson <https://www.linkedin.com/in/todd-stephenson-91a5a58/>"
 
 import base64
 import datetime
+import functools
+import io
 import json
 import logging
+import random
+import subprocess
+import threading
 import time
-import os
-from ffmpeg import FFmpeg
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    # Optional, faster parsing of large Lambda responses
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 log = logging.getLogger(__name__)
 
+class TokenBucket:
+    '''
+    Thread-safe token bucket to limit the write capacity units spent per second
+
+    After throttle() the rate is halved (down to 1/16 of the configured rate) for
+    throttle_window seconds.
+    '''
+    throttle_window = 10.0
+
+    def __init__(self, rate, capacity):
+        self.max_rate = self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.throttled_until = 0.
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        # Requests larger than the capacity (e.g., a 25-item batch against 5 WCU) are charged
+        # in full by letting the tokens go negative and sleeping off the debt. The lock is held
+        # while sleeping, so concurrent writers queue behind the sleeping one.
+        with self.lock:
+            now = time.monotonic()
+            if self.rate < self.max_rate and now >= self.throttled_until:
+                self.rate = self.max_rate
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= tokens
+            if self.tokens < 0:
+                time.sleep(-self.tokens / self.rate)
+
+    def throttle(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.throttled_until = time.monotonic() + self.throttle_window
+
+class Base64Payload(io.RawIOBase):
+    '''
+    Seekable stream of prefix, base64 of audio and suffix, encoded one chunk at a time on read
+
+    chunk_size must be a multiple of 3 so that the base64 output of each chunk can be
+    concatenated without padding in between.
+    '''
+    def __init__(self, prefix, audio, suffix, chunk_size):
+        self.prefix = prefix
+        self.audio = memoryview(audio)
+        self.suffix = suffix
+        self.chunk_size = chunk_size
+        self.encoded_chunk_size = chunk_size // 3 * 4
+        self.body_size = 4 * -(-len(self.audio) // 3)
+        self.size = len(self.prefix) + self.body_size + len(self.suffix)
+        self.position = 0
+        self.chunk_index, self.chunk = None, b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        written = 0
+        while written < len(view) and self.position < self.size:
+            data, offset = self.segment(self.position)
+            n = min(len(view) - written, len(data) - offset)
+            view[written:written + n] = data[offset:offset + n]
+            written += n
+            self.position += n
+        return written
+
+    def segment(self, position):
+        '''
+        Bytes containing position and the offset of position within them
+        '''
+        if position < len(self.prefix):
+            return self.prefix, position
+        position -= len(self.prefix)
+        if position >= self.body_size:
+            return self.suffix, position - self.body_size
+        chunk_index = position // self.encoded_chunk_size
+        if chunk_index != self.chunk_index:
+            start = chunk_index * self.chunk_size
+            self.chunk_index = chunk_index
+            self.chunk = base64.b64encode(self.audio[start:start + self.chunk_size])
+        return self.chunk, position - chunk_index * self.encoded_chunk_size
+
+@functools.lru_cache(maxsize=8)
+def _get_clients(session):
+    '''
+    Lambda and DynamoDB clients, shared by all AudioProcessing instances of a session
+    '''
+    return session.client("lambda"), session.client("dynamodb")
+
 class AudioProcessing:
     '''
     Analyze audio and store scores
+
+    With asynchronous=True the Lambda function is invoked with InvocationType='Event'
+    and is expected to write its own results to the DynamoDB table, using the
+    table_name and producer_timestamp_sec fields of the payload. Failures then have
+    to be handled by the function (e.g., a dead-letter queue) instead of here.
+    The payload limit of asynchronous invocations is 1 MB instead of 6 MB; audio
+    exceeding the limit is logged as an error and not analyzed.
+
+    With write_capacity_units set, writes to the DynamoDB table are limited to that
+    many items per second, which should match the provisioned WCU of the table.
+
+    With copy_compatible_audio=True the audio of the first MKV file is probed with ffprobe.
+    If it is already mono Vorbis at 22050 Hz, the audio of this and all later files is
+    copied into the ogg without transcoding. Copied audio skips the highpass=f=80 filter,
+    so its scores are not directly comparable to those of transcoded audio.
     '''
-    def __init__(self, session, function_name, table_name):
+    encode_chunk_size = 3 * 65536
+    reattempt_base_delay = 1.0
+    reattempt_max_delay = 30.0
+    max_attempts = 6
+    max_write_workers = 8
+    # Lambda invocation payload limits
+    max_sync_payload_size = 6 * 1024 * 1024
+    max_async_payload_size = 1024 * 1024
+    # None is replaced by the input file. Decoding and encoding use a single thread each,
+    # since the audio of a fragment is short
+    ffmpeg_args = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-threads", "1", "-i", None,
+                   "-threads", "1", "-vn", "-f", "ogg", "-q", "10", "-af", "highpass=f=80,pan=mono|c0=FL", "-ar", "22050",
+                   "pipe:1"]
+    # Used instead when the audio of the input is already mono Vorbis at 22050 Hz
+    ffmpeg_copy_args = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", None,
+                        "-vn", "-c:a", "copy", "-f", "ogg", "pipe:1"]
+    ffprobe_args = ["ffprobe", "-v", "error", "-select_streams", "a:0",
+                    "-show_entries", "stream=codec_name,sample_rate,channels", "-of", "json", None]
+
+    def __init__(self, session, function_name, table_name, asynchronous=False, write_capacity_units=None,
+                 copy_compatible_audio=False):
         self.session = session
-        self.lambda_client = self.session.client("lambda")
-        self.dynamodb_client = self.session.client("dynamodb")
+        self.lambda_client, self.dynamodb_client = _get_clients(self.session)
         self.function_name = function_name
         self.table_name = table_name
-        log.info(f"setup function {self.function_name} and table {self.table_name}")
+        self.asynchronous = asynchronous
+        # None until the first MKV file is probed
+        self.audio_is_target_format = None if copy_compatible_audio else False
+        self.rate_limiter = None
+        if write_capacity_units:
+            self.rate_limiter = TokenBucket(rate=write_capacity_units, capacity=write_capacity_units)
+        # Serialize the parameters that do not change between invocations once. Base64
+        # characters need no escaping, so the body is spliced in between these bytes
+        # instead of passing the whole payload through json.dumps.
+        parameters = {'threshold': 0.0}
+        if self.asynchronous:
+            parameters['table_name'] = self.table_name
+        self.payload_prefix = b'{"body":"'
+        self.payload_suffix = b'",' + json.dumps(parameters)[1:].encode()
+        log.info(f"setup function {self.function_name} and table {self.table_name}"
+                 f"{' (asynchronous)' if self.asynchronous else ''}")
 
     def __call__(self, mkv_file, fragment_tags):
-        reattempt_delay = 60
-        audio_file = os.path.splitext(mkv_file)[0] + '.ogg'
-        AudioProcessing.mkv2ogg(mkv_file, audio_file)
-        lambda_response = self.invoke_lambda(audio_file)
-        if not AudioProcessing.good_response(lambda_response):
+        if self.audio_is_target_format is None:
+            self.audio_is_target_format = AudioProcessing.is_target_format(mkv_file)
+            log.info(f"Audio of {mkv_file} is {'' if self.audio_is_target_format else 'not '}copied without transcoding")
+        audio = AudioProcessing.mkv2ogg(mkv_file, copy_audio=self.audio_is_target_format)
+        max_payload_size = self.max_async_payload_size if self.asynchronous else self.max_sync_payload_size
+        payload_size = self.make_payload(audio, fragment_tags).size
+        if payload_size > max_payload_size:
+            log.error(f"Payload of {payload_size} bytes exceeds the limit of {max_payload_size} bytes for "
+                      f"{'asynchronous' if self.asynchronous else 'synchronous'} invocation of {self.function_name}. "
+                      f"Not analyzing timestamp {fragment_tags['AWS_KINESISVIDEO_PRODUCER_TIMESTAMP']}.")
+            return
+        if self.asynchronous:
+            self.invoke_lambda(audio, fragment_tags)
+            return
+        # Truncated exponential backoff with jitter between attempts
+        for attempt in range(self.max_attempts):
+            lambda_response = self.invoke_lambda(audio)
+            if AudioProcessing.good_response(lambda_response) or attempt == self.max_attempts - 1:
+                break
+            reattempt_delay = (min(self.reattempt_max_delay, self.reattempt_base_delay * 2**attempt)
+                               * random.uniform(0.5, 1.0))
             log.warn(f"Function {self.function_name} response: {lambda_response['code']}. "
-                     f"Will try again after {reattempt_delay} seconds")
+                     f"Will try again after {reattempt_delay:.1f} seconds")
             time.sleep(reattempt_delay)
-            lambda_response = self.invoke_lambda(audio_file)
         if AudioProcessing.good_response(lambda_response):
             self.put_dynamodb(lambda_response, fragment_tags)
         else:
             log.warn(f"Function {self.function_name} response: {lambda_response['code']}. "
                      f"Not writing anything to {self.table_name}. "
                      f"Timestamp: {fragment_tags['AWS_KINESISVIDEO_PRODUCER_TIMESTAMP']}.")
-        os.remove(audio_file)
 
     @staticmethod
     def good_response(res):
         return res['code'] == 200
 
     @staticmethod
-    def mkv2ogg(mkv_file, audio_file):
-        output_options = {
-            "q": "10",
-            "af": "highpass=f=80,pan=mono|c0=FL",
-            "ar": "22050"
-        }
-        ffmpeg = FFmpeg().option("y").input(mkv_file).output(audio_file, output_options)
-        ffmpeg.execute()
-
-    def invoke_lambda(self, audio_file):
-        with open(audio_file, 'rb') as f:
-            payload_body = base64.b64encode(f.read()).decode('utf-8')
+    def mkv2ogg(mkv_file, copy_audio=False):
+        '''
+        Convert the audio of mkv_file to ogg and return it as bytes read from the stdout of ffmpeg
+
+        With copy_audio=True the audio is copied without transcoding or filtering.
+        '''
+        if copy_audio:
+            args = AudioProcessing.ffmpeg_copy_args.copy()
+        else:
+            args = AudioProcessing.ffmpeg_args.copy()
+        args[args.index(None)] = mkv_file
+        try:
+            # No stdin, otherwise ffmpeg reads keyboard commands from the terminal of the consumer
+            return subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  check=True).stdout
+        except subprocess.CalledProcessError as err:
+            raise RuntimeError(f"ffmpeg failed to convert {mkv_file} with exit status {err.returncode}: "
+                               f"{err.stderr.decode(errors='replace').strip()}") from err
+
+    @staticmethod
+    def is_target_format(mkv_file):
+        args = AudioProcessing.ffprobe_args.copy()
+        args[args.index(None)] = mkv_file
+        try:
+            probe = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+            streams = json.loads(probe.stdout).get('streams', [])
+        except (OSError, ValueError, subprocess.CalledProcessError) as err:
+            log.warn(f"Could not probe {mkv_file}, audio will be transcoded: {err}")
+            return False
+        return (len(streams) > 0 and streams[0].get('codec_name') == 'vorbis'
+                and streams[0].get('channels') == 1 and streams[0].get('sample_rate') == '22050')
+
+    @staticmethod
+    def producer_timestamp_sec(fragment_tags):
+        producer_timestamp_sec, _ = fragment_tags['AWS_KINESISVIDEO_PRODUCER_TIMESTAMP'].split('.')
+        return producer_timestamp_sec
+
+    def make_payload(self, audio, fragment_tags=None):
+        payload_prefix = self.payload_prefix
+        if self.asynchronous:
+            producer_timestamp_sec = AudioProcessing.producer_timestamp_sec(fragment_tags)
+            payload_prefix = (json.dumps({'producer_timestamp_sec': producer_timestamp_sec})[:-1].encode()
+                              + b',' + payload_prefix[1:])
+        # boto3 reads the payload twice (to sign and to send the request), so the
+        # base64 body is encoded on demand instead of being held in memory
+        return Base64Payload(payload_prefix, audio, self.payload_suffix, self.encode_chunk_size)
+
+    def invoke_lambda(self, audio, fragment_tags=None):
+        payload = self.make_payload(audio, fragment_tags)
         lambda_response = self.lambda_client.invoke(
             FunctionName=self.function_name,
-            Payload=json.dumps({'body': payload_body, 'threshold': 0.0}),
+            InvocationType='Event' if self.asynchronous else 'RequestResponse',
+            Payload=payload,
         )
-        lambda_response = json.loads(lambda_response['Payload'].read())
+        if self.asynchronous:
+            log.debug(f"Function {self.function_name} queued with status {lambda_response['StatusCode']}")
+            return None
+        lambda_response = json_loads(lambda_response['Payload'].read())
         return lambda_response
 
     def put_dynamodb(self, lambda_response, fragment_tags):
-        producer_timestamp_sec, _ = fragment_tags['AWS_KINESISVIDEO_PRODUCER_TIMESTAMP'].split('.')
-        request_items = [{'PutRequest': { 'Item': {
+        # The time attribute is the same for every item, so share a single dict
+        time_attribute = {'N': AudioProcessing.producer_timestamp_sec(fragment_tags)}
+        request_items = deque({'PutRequest': { 'Item': {
                        'species': {'S': species[0]},
-                       'time': {'N': producer_timestamp_sec},
-                       'score': {'N': str(round(score, 4))},
-        }}} for idx, species, score in lambda_response['top_results']]
+                       'time': time_attribute,
+                       'score': {'N': f"{score:.4f}"},
+        }}} for _, species, score in lambda_response['top_results'])
         # https://www.geeksforgeeks.org/break-list-chunks-size-n-python/
         batch_size = 25
         consumed_capacities, retry_attempts = [], []
         while len(request_items) > 0:
-            current_batch, request_items = request_items[:batch_size], request_items[batch_size:]
-            current_request = {self.table_name: current_batch}
-            rc = self.dynamodb_client.batch_write_item(RequestItems=current_request,
-                                                       ReturnConsumedCapacity='TOTAL')
-            unprocessed_items = rc['UnprocessedItems'].get(self.table_name, [])
-            if unprocessed_items:
-                log.warn(f"Batch write to {self.table_name} has unprocessed items. Will attempt to write them again in later batch(es):"
-                         f"{unprocessed_items}")
-                request_items.extend(unprocessed_items)
-            if len(rc['ConsumedCapacity'])>0:
-                consumed_capacities.append(rc['ConsumedCapacity'][0]['CapacityUnits'])
-            else:
-                consumed_capacities.append(0.)
-            retry_attempts.append(rc['ResponseMetadata']['RetryAttempts'])
+            # Write all batches of this round concurrently, unprocessed items go to the next round
+            batches = []
+            while len(request_items) > 0:
+                batches.append([request_items.popleft() for _ in range(min(batch_size, len(request_items)))])
+            with ThreadPoolExecutor(max_workers=min(self.max_write_workers, len(batches))) as executor:
+                responses = list(executor.map(self.batch_write, batches))
+            throttled = False
+            for rc in responses:
+                unprocessed_items = rc['UnprocessedItems'].get(self.table_name, [])
+                if unprocessed_items:
+                    throttled = True
+                    log.warn("Batch write to %s has %d unprocessed items. Will attempt to write them again in later batch(es)",
+                             self.table_name, len(unprocessed_items))
+                    log.debug("Unprocessed items: %s", unprocessed_items)
+                    request_items.extend(unprocessed_items)
+                if len(rc['ConsumedCapacity'])>0:
+                    consumed_capacities.append(rc['ConsumedCapacity'][0]['CapacityUnits'])
+                else:
+                    consumed_capacities.append(0.)
+                retry_attempts.append(rc['ResponseMetadata']['RetryAttempts'])
+            # Slow down once per round, however many of its concurrent batches were throttled
+            if throttled and self.rate_limiter:
+                self.rate_limiter.throttle()
         log.info(f"Timestamp {fragment_tags['AWS_KINESISVIDEO_PRODUCER_TIMESTAMP']}, "
                  f"Consumed Capacities: {consumed_capacities}, "
                  f"Retry Attempts: {retry_attempts}")
 
+    def batch_write(self, batch):
+        if self.rate_limiter:
+            self.rate_limiter.acquire(len(batch))
+        return self.dynamodb_client.batch_write_item(RequestItems={self.table_name: batch},
+                                                     ReturnConsumedCapacity='TOTAL')
@@ -21,6 +21,21 @@ Sample usage:
   DYNAMO_TABLE
   KVS_STREAM_NAME
   AWS_REGION
+- Optionally, export MKV_TIME_THRESH (default 60) to set how many seconds of fragments
+  are concatenated and analyzed with a single invocation of LAMBDA_FUNCTION.
+  Longer windows amortize the per-invocation overhead, but the encoded audio must stay
+  within the 6 MB synchronous invocation payload limit.
+- Optionally, export DYNAMO_WCU with the provisioned write capacity units of DYNAMO_TABLE
+  to limit the rate of writes to the table.
+- Optionally, export COPY_COMPATIBLE_AUDIO=1 to skip transcoding (and the highpass filter)
+  when the audio of the stream already is mono Vorbis at 22050 Hz. Requires ffprobe.
+- Optionally, export MKV_SCRATCH_DIR (default: the system temporary directory) to set where
+  the concatenated MKV file is written, e.g. /dev/shm to keep it in memory. The file includes
+  video and grows with MKV_TIME_THRESH, so make sure the directory has enough space.
+- Optionally, export LAMBDA_ASYNC=1 to invoke LAMBDA_FUNCTION asynchronously.
+  LAMBDA_FUNCTION then writes to DYNAMO_TABLE itself and needs dynamodb:BatchWriteItem.
+  Asynchronous invocations have a payload limit of 1 MB instead of 6 MB, so MKV_TIME_THRESH
+  may have to be reduced. Audio exceeding the limit is logged as an error and not analyzed.
 - Execute the following command:
   python kvs_consumer_library_example.py 20250901120000
 
@@ -29,6 +44,7 @@ Changelog:
 9/16/2025, Todd Stephenson: Modify get_media_wrapper() to support a custom start time
 2/25/2026, Todd Stephenson: Include time in logging messages
 2/25/2026, Todd Stephenson: Concatenate multiple fragments and process them as a single audio stream
+10/15/2026, Todd Stephenson: Configure AudioProcessing and the MKV batching window with environment variables
  '''
  
 __version__ = "0.0.1"
@@ -39,6 +55,7 @@ __author__ = "Dean Colcott <https://www.linkedin.com/in/deancolcott/>"
 import datetime
 import os
 import sys
+import tempfile
 import time
 import boto3
 import logging
@@ -83,9 +100,12 @@ class KvsPythonConsumerExample:
         # Attach session specific configuration (such as the authentication pattern)
         self.session = boto3.Session(region_name=REGION)
         self.kvs_client = self.session.client("kinesisvideo")
-        self.audio_processor = AudioProcessing(self.session, function_name=os.environ['LAMBDA_FUNCTION'], table_name=os.environ['DYNAMO_TABLE'])
+        self.audio_processor = AudioProcessing(self.session, function_name=os.environ['LAMBDA_FUNCTION'], table_name=os.environ['DYNAMO_TABLE'],
+                                               asynchronous=os.environ.get('LAMBDA_ASYNC') == '1',
+                                               write_capacity_units=float(os.environ.get('DYNAMO_WCU', 0)),
+                                               copy_compatible_audio=os.environ.get('COPY_COMPATIBLE_AUDIO') == '1')
         self.initial_start_selector = start_selector
-        self.mkv_time_thresh = 60
+        self.mkv_time_thresh = float(os.environ.get('MKV_TIME_THRESH', 60))
         self.curr_start_fragment_tags = None
 
     def get_media_wrapper(self, start_selector):
@@ -221,7 +241,7 @@ class KvsPythonConsumerExample:
             ###########################################
             # 3) Write the Fragment to disk as standalone MKV file
             ###########################################
-            save_dir = '/tmp'
+            save_dir = os.environ.get('MKV_SCRATCH_DIR', tempfile.gettempdir())
             # frag_file_name = self.last_good_fragment_tags['AWS_KINESISVIDEO_FRAGMENT_NUMBER'] + '.mkv' # Update as needed
             frag_file_name = 'concatented_kinesis_fragments.mkv' # Update as needed
             frag_file_path = os.path.join(save_dir, frag_file_name)